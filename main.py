@@ -11,6 +11,7 @@ import json
 
 from calculator import MetabolicCalculator
 from models import ClientInput
+from plan_history import PlanHistoryStore
 
 from stripe_paywall.checkout import router as stripe_checkout_router
 from stripe_paywall.verify import router as stripe_verify_router    
@@ -39,6 +40,12 @@ app.add_middleware(SessionMiddleware, secret_key=SESSION_SECRET_KEY)
 app.include_router(stripe_checkout_router)
 app.include_router(stripe_verify_router)
 calculator = MetabolicCalculator()
+plan_history = PlanHistoryStore(os.getenv("PLAN_HISTORY_DB", "plan_history.db"))
+
+
+@app.on_event("shutdown")
+def close_plan_history():
+    plan_history.close()
 
 def require_access(request: Request):
     access = request.cookies.get("calculator_access")
@@ -162,6 +169,7 @@ async def process_pending_calculation(request: Request):
     )
 
     plan = calculator.calculate_plan(client)
+    plan_history.record(client, plan)
     meal_plan = build_meal_plan(client, plan)
 
     return templates.TemplateResponse(
@@ -260,6 +268,7 @@ async def calculate_view(
     )
 
     plan = calculator.calculate_plan(client)
+    plan_history.record(client, plan)
     meal_plan = build_meal_plan(client, plan)
 
     return templates.TemplateResponse(
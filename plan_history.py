@@ -0,0 +1,569 @@
+import logging
+import math
+import queue
+import sqlite3
+import threading
+import time
+from dataclasses import asdict
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from calculator import ACTIVITY_MAP
+from models import ClientInput, PlanResult
+
+logger = logging.getLogger(__name__)
+
+# Numeric PlanResult fields that can be aggregated.
+METRICS = (
+    "bmr",
+    "tdee",
+    "calories",
+    "protein_g",
+    "fat_g",
+    "carb_g",
+    "activity_factor",
+    "lbs_to_lose",
+    "weeks_to_goal",
+    "weekly_loss",
+    "daily_deficit",
+)
+
+# Client fields that can be used for grouping / filtering.
+DIMENSIONS = ("goal", "activity", "sex")
+
+# Known values per dimension; anything else would mint new rollup keys,
+# so record() skips it. The form's activity options ("light", "moderate",
+# "extra_active") differ from ACTIVITY_MAP's keys, so both are accepted.
+_ALLOWED = {
+    "goal": {"lose", "maintain", "gain"},
+    "activity": set(ACTIVITY_MAP) | {"light", "moderate", "extra_active"},
+    "sex": {"male", "female"},
+}
+
+_CLIENT_COLUMNS = ("sex", "age", "activity", "goal", "preference")
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS plans (
+    id INTEGER PRIMARY KEY,
+    created_on TEXT NOT NULL,
+    sex TEXT NOT NULL,
+    age INTEGER NOT NULL,
+    activity TEXT NOT NULL,
+    goal TEXT NOT NULL,
+    preference TEXT NOT NULL,
+    {", ".join(f"{m} REAL NOT NULL" for m in METRICS)}
+);
+CREATE INDEX IF NOT EXISTS plans_created_on ON plans (created_on);
+CREATE INDEX IF NOT EXISTS plans_goal ON plans (goal, created_on);
+CREATE INDEX IF NOT EXISTS plans_activity ON plans (activity, created_on);
+CREATE INDEX IF NOT EXISTS plans_sex ON plans (sex, created_on);
+
+-- Sum and count of each metric per day and (goal, activity, sex).
+-- Tiny (at most 30 rows per metric per day), so means and counts read it
+-- for any date range.
+CREATE TABLE IF NOT EXISTS plan_totals (
+    metric TEXT NOT NULL,
+    period TEXT NOT NULL,
+    goal TEXT NOT NULL,
+    activity TEXT NOT NULL,
+    sex TEXT NOT NULL,
+    total REAL NOT NULL,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (metric, period, goal, activity, sex)
+) WITHOUT ROWID;
+"""
+
+# How many plans hit each metric value, per month ("YYYY-MM") and per year
+# ("YYYY") -> histograms and percentiles. Dimensions are pre-merged with
+# the "*" sentinel (all dimensions, each single dimension, and the full
+# combination), so a query reads one key per period and, for calories,
+# a few thousand rows per period no matter how many plans it covers.
+# Partial months at the edges of a range are read from the raw plans table.
+_VALUE_RESOLUTIONS = {"monthly": 7, "yearly": 4}  # period = created_on[:length]
+_ANY = "*"
+
+for _resolution in _VALUE_RESOLUTIONS:
+    _SCHEMA += f"""
+CREATE TABLE IF NOT EXISTS plan_values_{_resolution} (
+    metric TEXT NOT NULL,
+    goal TEXT NOT NULL,
+    activity TEXT NOT NULL,
+    sex TEXT NOT NULL,
+    period TEXT NOT NULL,
+    value REAL NOT NULL,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (metric, goal, activity, sex, period, value)
+) WITHOUT ROWID;
+"""
+
+_PLAN_COLUMNS = ", ".join(("created_on",) + _CLIENT_COLUMNS + METRICS)
+
+# Per-connection staging for the batch being written. The rollups are
+# computed from it in SQL, so the writer holds the GIL only long enough to
+# hand the rows over.
+_BATCH_SCHEMA = f"""
+CREATE TEMP TABLE IF NOT EXISTS batch_plans AS SELECT {_PLAN_COLUMNS} FROM plans WHERE 0;
+CREATE TEMP TABLE IF NOT EXISTS batch_values (
+    metric TEXT, created_on TEXT, goal TEXT, activity TEXT, sex TEXT, value REAL
+);
+"""
+
+_STAGE_BATCH = (
+    f"INSERT INTO temp.batch_plans ({_PLAN_COLUMNS}) "
+    f"VALUES ({', '.join('?' * (1 + len(_CLIENT_COLUMNS) + len(METRICS)))})"
+)
+
+# One row per (plan, metric).
+_UNPIVOT_BATCH = "INSERT INTO temp.batch_values " + " UNION ALL ".join(
+    f"SELECT '{m}', created_on, goal, activity, sex, {m} FROM temp.batch_plans"
+    for m in METRICS
+)
+
+_ROLLUP_BATCH = [
+    f"INSERT INTO plans ({_PLAN_COLUMNS}) SELECT {_PLAN_COLUMNS} FROM temp.batch_plans",
+    _UNPIVOT_BATCH,
+    # "WHERE true" keeps SQLite from reading ON CONFLICT as a join clause.
+    "INSERT INTO plan_totals (metric, period, goal, activity, sex, total, n) "
+    "SELECT metric, created_on, goal, activity, sex, SUM(value), COUNT(*) "
+    "FROM temp.batch_values WHERE true GROUP BY 1, 2, 3, 4, 5 "
+    "ON CONFLICT (metric, period, goal, activity, sex) "
+    "DO UPDATE SET total = total + excluded.total, n = n + excluded.n",
+]
+
+# Each plan is counted under these pre-merged (goal, activity, sex) keys.
+_GROUPING_SETS = (
+    ("goal", "activity", "sex"),
+    (f"'{_ANY}'", f"'{_ANY}'", f"'{_ANY}'"),
+    ("goal", f"'{_ANY}'", f"'{_ANY}'"),
+    (f"'{_ANY}'", "activity", f"'{_ANY}'"),
+    (f"'{_ANY}'", f"'{_ANY}'", "sex"),
+)
+
+for _resolution, _length in _VALUE_RESOLUTIONS.items():
+    for _goal, _activity, _sex in _GROUPING_SETS:
+        _ROLLUP_BATCH.append(
+            f"INSERT INTO plan_values_{_resolution} "
+            "(metric, goal, activity, sex, period, value, n) "
+            f"SELECT metric, {_goal}, {_activity}, {_sex}, "
+            f"substr(created_on, 1, {_length}), value, COUNT(*) "
+            "FROM temp.batch_values WHERE true GROUP BY 1, 2, 3, 4, 5, 6 "
+            "ON CONFLICT (metric, goal, activity, sex, period, value) "
+            "DO UPDATE SET n = n + excluded.n"
+        )
+
+_ROLLUP_BATCH += ["DELETE FROM temp.batch_plans", "DELETE FROM temp.batch_values"]
+
+_STOP = object()
+
+# "database is locked" and friends are usually another writer holding the
+# lock past the busy timeout, so those are retried with backoff.
+_WRITE_ATTEMPTS = 5
+_RETRY_DELAY = 0.1  # seconds, doubled after each attempt
+
+
+def _write_batch(conn: sqlite3.Connection, batch: List[tuple]) -> None:
+    """
+    Append a batch of plan rows to plans and fold it into the rollups, in
+    one transaction.
+    """
+    for attempt in range(_WRITE_ATTEMPTS):
+        try:
+            with conn:
+                conn.executemany(_STAGE_BATCH, batch)
+                for sql in _ROLLUP_BATCH:
+                    conn.execute(sql)
+            return
+        except sqlite3.OperationalError:
+            if attempt == _WRITE_ATTEMPTS - 1:
+                raise
+            logger.warning("Plan history write failed; retrying", exc_info=True)
+            time.sleep(_RETRY_DELAY * 2 ** attempt)
+
+
+def _add_months(day: date, months: int) -> date:
+    month = day.month - 1 + months
+    return day.replace(year=day.year + month // 12, month=month % 12 + 1)
+
+
+def _month_end(day: date) -> date:
+    return _add_months(day.replace(day=1), 1) - timedelta(days=1)
+
+
+class PlanHistoryStore:
+    """
+    Append-only SQLite store of computed plans.
+
+    - record() only enqueues; a background thread batches rows into the DB
+      so the request path never waits on disk.
+    - Only anonymous inputs are kept (no names or emails).
+    - Every batch also updates the rollup tables; aggregates run as SQL
+      against those (and the indexed plans table for partial months), so
+      Python only ever sees grouped results, never rows.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        max_pending: int = 100_000,
+        busy_timeout: float = 5.0,
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.busy_timeout = busy_timeout
+        # Bounded so a stalled writer can't grow the web process without limit.
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+        conn.close()
+
+        self._writer = threading.Thread(
+            target=self._write_loop, name="plan-history-writer", daemon=True
+        )
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path, timeout=self.busy_timeout, check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")  # readers don't block the writer
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # ---- writes ----
+
+    def record(
+        self, client: ClientInput, plan: PlanResult, created_on: Optional[date] = None
+    ) -> None:
+        created_on = created_on or date.today()
+        for column, allowed in _ALLOWED.items():
+            if getattr(client, column) not in allowed:
+                logger.warning(
+                    "Skipping plan with unknown %s: %r", column, getattr(client, column)
+                )
+                return
+        plan_fields = asdict(plan)
+        metrics = tuple(plan_fields[m] for m in METRICS)
+        if not all(math.isfinite(v) for v in metrics):
+            # e.g. goal_weight=nan; SQLite would store NULL and fail the batch.
+            logger.warning("Skipping plan with non-finite metrics: %s", metrics)
+            return
+        row = (
+            (created_on.isoformat(),)
+            + tuple(getattr(client, c) for c in _CLIENT_COLUMNS)
+            + metrics
+        )
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            logger.error("Plan history queue is full; dropping plan")
+
+    def flush(self) -> None:
+        """
+        Block until everything recorded so far has been written.
+        Raises RuntimeError if the store is closed.
+        """
+        done = threading.Event()
+        if self._writer.is_alive():
+            self._queue.put(done)
+        while not done.wait(0.1):
+            if not self._writer.is_alive():
+                raise RuntimeError("Plan history writer is not running")
+
+    def close(self) -> None:
+        if self._writer.is_alive():
+            self._queue.put(_STOP)
+        self._writer.join()
+
+    def _write_loop(self) -> None:
+        conn = self._connect()
+        conn.executescript(_BATCH_SCHEMA)
+        stopping = False
+        while not stopping:
+            batch: List[tuple] = []
+            waiters: List[threading.Event] = []
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            # Drain whatever else is already queued, up to batch_size rows.
+            while True:
+                if item is _STOP:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                if stopping or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            try:
+                self._write(conn, batch)
+            finally:
+                for waiter in waiters:
+                    waiter.set()
+        conn.close()
+
+    def _write(self, conn: sqlite3.Connection, batch: List[tuple]) -> None:
+        """
+        Write a batch; if it fails, write its rows one by one so only the
+        rows that really can't be stored are dropped.
+        """
+        if not batch:
+            return
+        try:
+            _write_batch(conn, batch)
+            return
+        except Exception:
+            if len(batch) == 1:
+                logger.exception("Dropping plan that could not be written: %s", batch[0])
+                return
+            logger.exception(
+                "Failed to write %d plans to history; retrying one by one", len(batch)
+            )
+        for row in batch:
+            self._write(conn, [row])
+
+    # ---- queries ----
+
+    @staticmethod
+    def _check(metric: str, filters: Optional[Dict[str, str]]) -> Dict[str, str]:
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+        for column in filters or {}:
+            if column not in DIMENSIONS:
+                raise ValueError(f"Unknown filter: {column}")
+        return dict(filters or {})
+
+    def _totals_source(
+        self,
+        columns: str,
+        metric: str,
+        filters: Optional[Dict[str, str]],
+        since: Optional[date],
+        until: Optional[date],
+    ) -> Tuple[str, list]:
+        """
+        Subquery over plan_totals rows for [since, until].
+        """
+        filters = self._check(metric, filters)
+        clauses = ["metric = ?"] + [f"{column} = ?" for column in filters]
+        params = [metric] + list(filters.values())
+        if since:
+            clauses.append("period >= ?")
+            params.append(since.isoformat())
+        if until:
+            clauses.append("period <= ?")
+            params.append(until.isoformat())
+        sql = f"(SELECT {columns} FROM plan_totals WHERE {' AND '.join(clauses)})"
+        return sql, params
+
+    def _values_source(
+        self,
+        metric: str,
+        filters: Optional[Dict[str, str]],
+        since: Optional[date],
+        until: Optional[date],
+    ) -> Tuple[str, list]:
+        """
+        Subquery of (value, n) rows covering [since, until]: whole years from
+        plan_values_yearly, remaining whole months from plan_values_monthly,
+        and partial months at either edge from the raw plans table.
+        """
+        filters = self._check(metric, filters)
+
+        # Bounds past the recorded data can be dropped, so that e.g. "this
+        # month so far" still counts as a whole month.
+        first_day, last_day = self._query(
+            "SELECT MIN(created_on), MAX(created_on) FROM plans", []
+        )[0]
+        if since and first_day and since.isoformat() <= first_day:
+            since = None
+        if until and last_day and until.isoformat() >= last_day:
+            until = None
+
+        # Pre-merged key for these filters: fixed dimensions match, others
+        # are "*" (one filter or none) or the full combinations (two or more).
+        dims, dim_params = [], []
+        for column in DIMENSIONS:
+            if column in filters:
+                dims.append(f"{column} = ?")
+                dim_params.append(filters[column])
+            elif len(filters) < 2:
+                dims.append(f"{column} = '{_ANY}'")
+            else:
+                dims.append(f"{column} != '{_ANY}'")
+
+        parts, params = [], []
+
+        def add_rollup(resolution: str, start: Optional[date], end: Optional[date]):
+            length = _VALUE_RESOLUTIONS[resolution]
+            clauses = ["metric = ?"] + dims
+            params.extend([metric] + dim_params)
+            if start:
+                clauses.append("period >= ?")
+                params.append(start.isoformat()[:length])
+            if end:
+                clauses.append("period <= ?")
+                params.append(end.isoformat()[:length])
+            parts.append(
+                f"SELECT value, n FROM plan_values_{resolution} "
+                f"WHERE {' AND '.join(clauses)}"
+            )
+
+        def add_raw(start: date, end: date):
+            clauses = ["created_on >= ?", "created_on <= ?"]
+            clauses += [f"{column} = ?" for column in filters]
+            params.extend([start.isoformat(), end.isoformat()] + list(filters.values()))
+            parts.append(
+                f"SELECT {metric} AS value, 1 AS n FROM plans "
+                f"WHERE {' AND '.join(clauses)}"
+            )
+
+        # Whole months inside the range (None = unbounded).
+        first_month = since
+        if since and since.day != 1:
+            first_month = _add_months(since.replace(day=1), 1)
+        last_month_end = until
+        if until and _month_end(until) != until:
+            last_month_end = until.replace(day=1) - timedelta(days=1)
+
+        if first_month and last_month_end and first_month > last_month_end:
+            if since <= until:
+                add_raw(since, until)
+        else:
+            if since and since < first_month:
+                add_raw(since, first_month - timedelta(days=1))
+            if until and until > last_month_end:
+                add_raw(last_month_end + timedelta(days=1), until)
+
+            # Whole years inside the whole months, the rest month by month.
+            first_year = first_month
+            if first_month and first_month.month != 1:
+                first_year = date(first_month.year + 1, 1, 1)
+            last_year_end = last_month_end
+            if last_month_end and last_month_end.month != 12:
+                last_year_end = date(last_month_end.year - 1, 12, 31)
+
+            if first_year and last_year_end and first_year > last_year_end:
+                add_rollup("monthly", first_month, last_month_end)
+            else:
+                add_rollup("yearly", first_year, last_year_end)
+                if first_month and first_month < first_year:
+                    add_rollup("monthly", first_month, first_year - timedelta(days=1))
+                if last_month_end and last_month_end > last_year_end:
+                    add_rollup(
+                        "monthly", last_year_end + timedelta(days=1), last_month_end
+                    )
+
+        if not parts:
+            return "(SELECT NULL AS value, 0 AS n WHERE 0)", []
+        return f"({' UNION ALL '.join(parts)})", params
+
+    def _query(self, sql: str, params: list) -> List[tuple]:
+        conn = self._connect()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def count(
+        self,
+        filters: Optional[Dict[str, str]] = None,
+        since: Optional[date] = None,
+        until: Optional[date] = None,
+    ) -> int:
+        # Every plan contributes exactly once to each metric, so any one will do.
+        source, params = self._totals_source("n", "bmr", filters, since, until)
+        return self._query(f"SELECT COALESCE(SUM(n), 0) FROM {source}", params)[0][0]
+
+    def histogram(
+        self,
+        metric: str,
+        bin_width: float,
+        filters: Optional[Dict[str, str]] = None,
+        since: Optional[date] = None,
+        until: Optional[date] = None,
+    ) -> List[Tuple[float, int]]:
+        """
+        Returns: [(bin_start, count), ...] sorted by bin_start.
+        Bin k covers [k * bin_width, (k + 1) * bin_width), including for
+        negative k (out-of-range inputs can make bmr or calories negative).
+        """
+        if bin_width <= 0:
+            raise ValueError("bin_width must be positive")
+        source, params = self._values_source(metric, filters, since, until)
+        # ROUND first so values on an edge (0.3 / 0.1 = 2.999...) don't
+        # drop a bin. CAST truncates toward zero, so step negative
+        # non-integers down one to get floor.
+        sql = (
+            "SELECT CAST(q AS INTEGER) - (q < CAST(q AS INTEGER)) AS bin, SUM(n) "
+            f"FROM (SELECT ROUND(value / ?, 9) AS q, n FROM {source}) "
+            "GROUP BY bin ORDER BY bin"
+        )
+        rows = self._query(sql, [bin_width] + params)
+        return [(b * bin_width, n) for b, n in rows]
+
+    def percentiles(
+        self,
+        metric: str,
+        percents: List[float],
+        filters: Optional[Dict[str, str]] = None,
+        since: Optional[date] = None,
+        until: Optional[date] = None,
+    ) -> Dict[float, Optional[float]]:
+        """
+        Nearest-rank percentiles, found by walking the (value, count) table
+        instead of sorting every plan.
+        """
+        for p in percents:
+            if not 0 <= p <= 100:
+                raise ValueError("percentiles must be between 0 and 100")
+        source, params = self._values_source(metric, filters, since, until)
+        sql = f"SELECT value, SUM(n) FROM {source} GROUP BY value ORDER BY value"
+        rows = self._query(sql, params)
+        total = sum(n for _, n in rows)
+        if not total:
+            return {p: None for p in percents}
+
+        result = {}
+        targets = sorted((max(math.ceil(p * total / 100), 1), p) for p in percents)
+        seen, i = 0, 0
+        for value, n in rows:
+            seen += n
+            while i < len(targets) and targets[i][0] <= seen:
+                result[targets[i][1]] = value
+                i += 1
+            if i == len(targets):
+                break
+        return {p: result[p] for p in percents}
+
+    def grouped_mean(
+        self,
+        metric: str,
+        group_by: str,
+        filters: Optional[Dict[str, str]] = None,
+        since: Optional[date] = None,
+        until: Optional[date] = None,
+    ) -> Dict[str, Tuple[float, int]]:
+        """
+        Returns: {group_value: (mean, count)}
+        """
+        if group_by not in DIMENSIONS:
+            raise ValueError(f"Unknown group_by: {group_by}")
+        source, params = self._totals_source(
+            f"{group_by}, total, n", metric, filters, since, until
+        )
+        sql = (
+            f"SELECT {group_by}, SUM(total) / SUM(n), SUM(n) FROM {source} "
+            f"GROUP BY {group_by} ORDER BY {group_by}"
+        )
+        return {g: (mean, n) for g, mean, n in self._query(sql, params)}
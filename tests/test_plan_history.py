@@ -0,0 +1,292 @@
+import math
+import random
+import sqlite3
+import threading
+import time
+from dataclasses import replace
+from datetime import date, timedelta
+
+import pytest
+
+from calculator import ACTIVITY_MAP, MetabolicCalculator
+from models import ClientInput
+from plan_history import PlanHistoryStore
+
+
+FIRST_DAY = date(2024, 11, 20)
+LAST_DAY = date(2026, 5, 10)
+
+
+def make_client(rng: random.Random) -> ClientInput:
+    return ClientInput(
+        first_name="Test",
+        last_name="Client",
+        email="test@example.com",
+        sex=rng.choice(["male", "female"]),
+        age=rng.randint(20, 65),
+        weight=rng.randint(130, 280),
+        weight_unit="lb",
+        height=rng.randint(60, 76),
+        height_unit="in",
+        activity=rng.choice(list(ACTIVITY_MAP)),
+        goal=rng.choice(["lose", "maintain", "gain"]),
+        intensity="moderate",
+        preference="balanced",
+        goal_weight=rng.randint(120, 200),
+        goal_weight_unit="lb",
+        goal_date=date.today() + timedelta(days=rng.randint(14, 365)),
+    )
+
+
+@pytest.fixture(scope="module")
+def store(tmp_path_factory):
+    rng = random.Random(26)
+    calculator = MetabolicCalculator()
+    store = PlanHistoryStore(str(tmp_path_factory.mktemp("history") / "plans.db"))
+    span = (LAST_DAY - FIRST_DAY).days
+    for _ in range(3000):
+        client = make_client(rng)
+        created_on = FIRST_DAY + timedelta(days=rng.randint(0, span))
+        store.record(client, calculator.calculate_plan(client), created_on=created_on)
+    store.flush()
+    yield store
+    store.close()
+
+
+def raw_values(store, metric, since=None, until=None, **filters):
+    """
+    Brute-force answer straight from the raw plans table.
+    """
+    clauses, params = [], []
+    if since:
+        clauses.append("created_on >= ?")
+        params.append(since.isoformat())
+    if until:
+        clauses.append("created_on <= ?")
+        params.append(until.isoformat())
+    for column, value in filters.items():
+        clauses.append(f"{column} = ?")
+        params.append(value)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    conn = sqlite3.connect(store.path)
+    try:
+        rows = conn.execute(f"SELECT goal, {metric} FROM plans {where}", params)
+        return rows.fetchall()
+    finally:
+        conn.close()
+
+
+RANGES = [
+    pytest.param(None, None, id="unbounded"),
+    pytest.param(date(2026, 1, 1), date(2026, 1, 31), id="single-month"),
+    pytest.param(date(2026, 2, 10), date(2026, 2, 20), id="within-month"),
+    pytest.param(date(2026, 3, 7), date(2026, 3, 7), id="single-day"),
+    pytest.param(date(2025, 12, 15), date(2026, 3, 10), id="partial-edges"),
+    pytest.param(date(2025, 12, 1), date(2026, 2, 14), id="partial-end"),
+    pytest.param(date(2026, 1, 31), date(2026, 2, 1), id="month-boundary"),
+    pytest.param(date(2026, 4, 5), None, id="open-end"),
+    pytest.param(None, date(2026, 1, 12), id="open-start"),
+    pytest.param(date(2026, 3, 20), date(2026, 3, 5), id="since-after-until"),
+    pytest.param(date(2026, 4, 1), date(2026, 3, 31), id="adjacent-inverted"),
+    pytest.param(date(2025, 1, 1), date(2025, 12, 31), id="whole-year"),
+    pytest.param(date(2024, 12, 1), date(2026, 2, 28), id="year-and-months"),
+    pytest.param(date(2024, 12, 10), date(2026, 2, 3), id="year-months-days"),
+    pytest.param(date(2025, 1, 1), None, id="open-end-from-year"),
+    pytest.param(None, date(2025, 12, 31), id="open-start-to-year"),
+    pytest.param(date(2023, 1, 1), date(2027, 12, 31), id="beyond-data"),
+]
+
+FILTERS = [
+    pytest.param({}, id="no-filter"),
+    pytest.param({"activity": "sedentary"}, id="one-filter"),
+    pytest.param({"goal": "lose", "sex": "female"}, id="two-filters"),
+    pytest.param(
+        {"goal": "gain", "activity": "very_active", "sex": "male"}, id="three-filters"
+    ),
+]
+
+
+@pytest.mark.parametrize("since, until", RANGES)
+def test_count_matches_raw_table(store, since, until):
+    assert store.count(since=since, until=until) == len(
+        raw_values(store, "bmr", since, until)
+    )
+    assert store.count({"goal": "lose"}, since, until) == len(
+        raw_values(store, "bmr", since, until, goal="lose")
+    )
+
+
+@pytest.mark.parametrize("since, until", RANGES)
+def test_grouped_mean_matches_raw_table(store, since, until):
+    expected = {}
+    for goal, value in raw_values(store, "weeks_to_goal", since, until):
+        expected.setdefault(goal, []).append(value)
+
+    result = store.grouped_mean("weeks_to_goal", "goal", since=since, until=until)
+
+    assert set(result) == set(expected)
+    for goal, values in expected.items():
+        mean, n = result[goal]
+        assert n == len(values)
+        assert mean == pytest.approx(sum(values) / len(values))
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+@pytest.mark.parametrize("since, until", RANGES)
+def test_percentiles_match_raw_table(store, since, until, filters):
+    values = sorted(v for _, v in raw_values(store, "calories", since, until, **filters))
+    percents = [0, 10, 50, 90, 100]
+
+    result = store.percentiles("calories", percents, filters, since, until)
+
+    for p in percents:
+        if values:
+            assert result[p] == values[max(math.ceil(p * len(values) / 100), 1) - 1]
+        else:
+            assert result[p] is None
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+@pytest.mark.parametrize("since, until", RANGES)
+def test_histogram_matches_raw_table(store, since, until, filters):
+    expected = {}
+    for _, value in raw_values(store, "calories", since, until, **filters):
+        start = (value // 250) * 250
+        expected[start] = expected.get(start, 0) + 1
+
+    result = store.histogram("calories", 250, filters, since, until)
+
+    assert dict(result) == expected
+
+
+def test_histogram_puts_edge_values_in_upper_bin(tmp_path):
+    calculator = MetabolicCalculator()
+    client = make_client(random.Random(1))
+    plan = replace(calculator.calculate_plan(client), weekly_loss=0.3)
+    store = PlanHistoryStore(str(tmp_path / "plans.db"))
+    store.record(client, plan)
+    store.flush()
+
+    assert store.histogram("weekly_loss", 0.1) == [(pytest.approx(0.3), 1)]
+    store.close()
+
+
+def test_histogram_floors_negative_values(tmp_path):
+    calculator = MetabolicCalculator()
+    client = make_client(random.Random(5))
+    plan = calculator.calculate_plan(client)
+    store = PlanHistoryStore(str(tmp_path / "plans.db"))
+    for calories in (-150, -100, 50):
+        store.record(client, replace(plan, calories=calories))
+    store.flush()
+
+    assert store.histogram("calories", 100) == [(-200, 1), (-100, 1), (0, 1)]
+    store.close()
+
+
+@pytest.mark.parametrize(
+    "column, value, kept",
+    [
+        ("sex", "other", False),
+        ("goal", "*", False),
+        ("activity", "'; DROP TABLE plans; --", False),
+        ("activity", "light", True),
+        ("activity", "moderately_active", True),
+    ],
+)
+def test_unknown_dimension_values_are_skipped(tmp_path, column, value, kept):
+    calculator = MetabolicCalculator()
+    client = make_client(random.Random(6))
+    setattr(client, column, value)
+    store = PlanHistoryStore(str(tmp_path / "plans.db"))
+
+    store.record(client, calculator.calculate_plan(client))
+    store.flush()
+
+    assert store.count() == (1 if kept else 0)
+    store.close()
+
+
+def test_unknown_metric_and_filter_are_rejected(store):
+    with pytest.raises(ValueError):
+        store.histogram("email", 10)
+    with pytest.raises(ValueError):
+        store.count({"preference": "balanced"})
+
+
+def flush_with_timeout(store, timeout=5.0) -> bool:
+    flusher = threading.Thread(target=store.flush, daemon=True)
+    flusher.start()
+    flusher.join(timeout)
+    return not flusher.is_alive()
+
+
+def test_non_finite_plan_is_skipped(tmp_path):
+    calculator = MetabolicCalculator()
+    client = make_client(random.Random(2))
+    client.goal = "lose"
+    client.goal_weight = float("nan")
+    store = PlanHistoryStore(str(tmp_path / "plans.db"))
+
+    store.record(client, calculator.calculate_plan(client))
+
+    assert flush_with_timeout(store)
+    assert store.count() == 0
+    store.close()
+
+
+def test_bad_row_does_not_drop_the_rest_of_its_batch(tmp_path):
+    path = str(tmp_path / "plans.db")
+    store = PlanHistoryStore(path)
+    calculator = MetabolicCalculator()
+    rng = random.Random(3)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TRIGGER reject_age BEFORE INSERT ON plans WHEN NEW.age = 99 "
+        "BEGIN SELECT RAISE(ABORT, 'rejected'); END"
+    )
+    conn.commit()
+
+    # Hold the write lock so the plans queue up and are written as one batch.
+    conn.execute("BEGIN IMMEDIATE")
+    for age in (30, 31, 99, 32, 33):
+        client = make_client(rng)
+        client.age = age
+        store.record(client, calculator.calculate_plan(client))
+    time.sleep(0.2)
+    conn.rollback()
+
+    assert flush_with_timeout(store)
+    assert store.count() == 4
+    store.close()
+    conn.close()
+
+
+def test_locked_database_is_retried(tmp_path):
+    path = str(tmp_path / "plans.db")
+    store = PlanHistoryStore(path, busy_timeout=0.05)
+    calculator = MetabolicCalculator()
+    rng = random.Random(4)
+    conn = sqlite3.connect(path)
+
+    # Longer than the busy timeout, shorter than the retry backoff.
+    conn.execute("BEGIN IMMEDIATE")
+    for _ in range(3):
+        client = make_client(rng)
+        store.record(client, calculator.calculate_plan(client))
+    time.sleep(0.5)
+    conn.rollback()
+
+    assert flush_with_timeout(store)
+    assert store.count() == 3
+    store.close()
+    conn.close()
+
+
+def test_flush_after_close_raises(tmp_path):
+    store = PlanHistoryStore(str(tmp_path / "plans.db"))
+    store.close()
+
+    with pytest.raises(RuntimeError):
+        store.flush()
+    store.close()
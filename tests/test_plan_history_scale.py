@@ -0,0 +1,129 @@
+import os
+import sqlite3
+import time
+from datetime import date
+
+import pytest
+
+from plan_history import PlanHistoryStore
+
+
+YEARS = (2024, 2025)
+GOALS = ("lose", "maintain", "gain")
+ACTIVITIES = ("sedentary", "light", "moderate", "very_active", "extra_active")
+SEXES = ("female", "male")
+DISTINCT_CALORIES = 2500
+LATENCY_TARGET = 1.0  # seconds
+
+# Building the fixture takes ~30s, so this only runs on request:
+#   PLAN_HISTORY_SCALE=1 python -m pytest tests/test_plan_history_scale.py
+pytestmark = pytest.mark.skipif(
+    not os.getenv("PLAN_HISTORY_SCALE"), reason="set PLAN_HISTORY_SCALE=1 to run"
+)
+
+
+@pytest.fixture(scope="module")
+def big_store(tmp_path_factory):
+    """
+    Rollups as the writer would leave them after roughly 20M plans over two
+    years (~28k plans per month per goal/activity/sex, each spread over
+    2500 distinct calorie values). Built with SQL because pushing that many
+    plans through record() would take far too long for a test run.
+    """
+    path = str(tmp_path_factory.mktemp("history") / "plans.db")
+    store = PlanHistoryStore(path)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-200000")
+    with conn:
+        for table, rows in (
+            ("goals", GOALS),
+            ("activities", ACTIVITIES),
+            ("sexes", SEXES),
+            ("months", [f"{y}-{m:02d}" for y in YEARS for m in range(1, 13)]),
+        ):
+            conn.execute(f"CREATE TEMP TABLE {table} (name TEXT)")
+            conn.executemany(f"INSERT INTO {table} VALUES (?)", [(r,) for r in rows])
+        conn.execute("CREATE TEMP TABLE calories (v INTEGER)")
+        conn.executemany(
+            "INSERT INTO calories VALUES (?)", [(v,) for v in range(DISTINCT_CALORIES)]
+        )
+
+        # Full combinations, then the pre-merged "*" keys derived from them.
+        conn.execute(
+            "INSERT INTO plan_values_monthly "
+            "SELECT 'calories', g.name, a.name, s.name, m.name, 1500 + c.v, "
+            f"1 + c.v * ({DISTINCT_CALORIES} - c.v) / 100000 "
+            "FROM goals g, activities a, sexes s, months m, calories c"
+        )
+        for goal, activity, sex in (
+            ("'*'", "'*'", "'*'"),
+            ("goal", "'*'", "'*'"),
+            ("'*'", "activity", "'*'"),
+            ("'*'", "'*'", "sex"),
+        ):
+            conn.execute(
+                "INSERT INTO plan_values_monthly "
+                f"SELECT metric, {goal}, {activity}, {sex}, period, value, SUM(n) "
+                "FROM plan_values_monthly WHERE goal != '*' AND activity != '*' "
+                "AND sex != '*' GROUP BY 1, 2, 3, 4, 5, 6"
+            )
+        conn.execute(
+            "INSERT INTO plan_values_yearly "
+            "SELECT metric, goal, activity, sex, substr(period, 1, 4), value, SUM(n) "
+            "FROM plan_values_monthly GROUP BY 1, 2, 3, 4, 5, 6"
+        )
+        conn.execute(
+            "INSERT INTO plan_totals "
+            "SELECT 'bmr', period || '-15', goal, activity, sex, SUM(value * n), SUM(n) "
+            "FROM plan_values_monthly WHERE goal != '*' AND activity != '*' "
+            "AND sex != '*' GROUP BY 2, 3, 4, 5"
+        )
+    conn.close()
+    yield store
+    store.close()
+
+
+def test_store_holds_tens_of_millions_of_plans(big_store):
+    assert big_store.count() > 10_000_000
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        pytest.param(lambda s: s.histogram("calories", 100), id="histogram-all"),
+        pytest.param(
+            lambda s: s.histogram(
+                "calories", 100, since=date(2025, 1, 1), until=date(2025, 12, 31)
+            ),
+            id="histogram-year",
+        ),
+        pytest.param(
+            lambda s: s.histogram(
+                "calories", 100, since=date(2024, 3, 1), until=date(2025, 10, 31)
+            ),
+            id="histogram-months",
+        ),
+        pytest.param(
+            lambda s: s.histogram("calories", 100, {"activity": "moderate"}),
+            id="histogram-one-filter",
+        ),
+        pytest.param(
+            lambda s: s.percentiles(
+                "calories",
+                [10, 50, 90],
+                {"goal": "lose", "sex": "female"},
+                since=date(2024, 2, 1),
+                until=date(2025, 11, 30),
+            ),
+            id="percentiles-two-filters",
+        ),
+        pytest.param(lambda s: s.percentiles("calories", [50]), id="percentiles-all"),
+        pytest.param(lambda s: s.grouped_mean("bmr", "activity"), id="mean-all"),
+        pytest.param(lambda s: s.count({"goal": "gain"}), id="count-one-filter"),
+    ],
+)
+def test_aggregates_meet_latency_target(big_store, query):
+    start = time.perf_counter()
+    query(big_store)
+    assert time.perf_counter() - start < LATENCY_TARGET